@@ -1,9 +1,13 @@
 # main.py
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
+import reportlab
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.lib import colors
@@ -14,9 +18,48 @@ from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.platypus import Paragraph
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.enums import TA_CENTER
-import os, shutil, math, traceback
-
-app = FastAPI()
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from contextlib import asynccontextmanager, suppress
+from itertools import cycle, islice
+import anyio.to_thread
+import asyncio, functools, hashlib, io, logging, os, re, shutil, tempfile, threading, traceback
+
+logger = logging.getLogger("perfume_label")
+
+# Logo writes, cache I/O and (without a process pool) PDF rendering are
+# offloaded to anyio's worker threadpool; this caps how many run concurrently.
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "40"))
+
+# ReportLab rendering is CPU-bound Python, so threads serialize on the GIL.
+# PDF_WORKERS > 0 renders in that many worker processes instead.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", str(min(os.cpu_count() or 1, 6))))
+
+def _new_pdf_pool() -> ProcessPoolExecutor:
+    # forkserver children start from a clean interpreter instead of a fork of
+    # the threaded server (locks held mid-request, anyio/uvicorn state).
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context(method))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    app.state.pdf_pool = None
+    if PDF_WORKERS > 0:
+        try:
+            app.state.pdf_pool = _new_pdf_pool()
+            # Bound queued jobs so a burst of requests doesn't pile up in the pool.
+            app.state.pdf_slots = asyncio.Semaphore(PDF_WORKERS * 2)
+        except (OSError, NotImplementedError) as e:
+            # e.g. serverless runtimes without /dev/shm
+            logger.warning("process pool unavailable, rendering in threads: %s", e)
+    yield
+    if app.state.pdf_pool is not None:
+        app.state.pdf_pool.shutdown(cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
 
 # ===== CORS =====
 origins = [
@@ -33,22 +76,134 @@ app.add_middleware(
 
 MM_TO_PT = 2.83465
 
+# Type 1 fonts ReportLab can always use without registration.
+STANDARD_FONTS = frozenset(pdfmetrics.standardFonts)
+
+_PAGE_W_MM = A4[0] / MM_TO_PT
+_PAGE_H_MM = A4[1] / MM_TO_PT
+
 def mm_to_pt(mm: float) -> float:
     return float(mm) * MM_TO_PT
 
+# #RRGGBB, optionally followed by an alpha pair (#RRGGBBAA) that is ignored.
+_HEX_COLOR_RE = re.compile(r"#?[0-9A-Fa-f]{6}(?:[0-9A-Fa-f]{2})?")
+# Digits with optional separators; at least one digit is required.
+_PRICE_RE = re.compile(r"[ ,]*\d[\d ,]*")
+_MULTIPLIER_RE = re.compile(r"[ ×x]*\d[\d ×x]*")
+
+def hex_to_rgb(value: str) -> tuple:
+    v = int(value.lstrip("#")[:6], 16)
+    return ((v >> 16) / 255, ((v >> 8) & 0xFF) / 255, (v & 0xFF) / 255)
+
+@functools.lru_cache(maxsize=1024)
+def _text_width(text: str, font: str, size: float) -> float:
+    # Shop names, price strings and phones repeat across labels and requests.
+    return stringWidth(text, font, size)
+
+_arabic_search = re.compile(r"[\u0600-\u06FF\u0750-\u077F]").search
+
+def contains_arabic(s: str) -> bool:
+    return bool(s) and _arabic_search(s) is not None
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-OUT_PDF = os.path.join(BASE_DIR, "labels.pdf")
 LOGO_PATH = os.path.join(BASE_DIR, "logo.png")
+UPLOAD_CHUNK = 1 << 20  # 1 MiB copy/write buffer for logo uploads
+# Serverless hosts (vercel.json) only allow writes under the temp dir.
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "perfume-label-cache")
+_PDF_CACHE_ENABLED = True  # switched off if PDF_CACHE_DIR can't be created
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", str(50 << 20)))
 AMIRI_TTF = os.path.join(BASE_DIR, "Amiri-Regular.ttf")
 
-ARABIC_FONT = None
-if os.path.exists(AMIRI_TTF):
+FONTS_DIR = os.path.join(BASE_DIR, "fonts")
+
+ARABIC_FONT = "Amiri"
+_AMIRI_READY = None  # None: not tried yet, then True/False
+_AMIRI_LOCK = threading.Lock()
+
+def ensure_amiri() -> bool:
+    """Register Amiri on first use, so Latin-only workloads never parse the TTF."""
+    global _AMIRI_READY
+    if _AMIRI_READY is None:
+        with _AMIRI_LOCK:
+            if _AMIRI_READY is None:
+                # Publish the result only once the attempt is over, so other
+                # threads wait on the lock instead of reading an early False.
+                ready = False
+                if os.path.exists(AMIRI_TTF):
+                    try:
+                        pdfmetrics.registerFont(TTFont(ARABIC_FONT, AMIRI_TTF))
+                        ready = True
+                        logger.info("Amiri font registered")
+                    except Exception as e:
+                        logger.warning("failed to register Amiri: %s", e)
+                _AMIRI_READY = ready
+    return _AMIRI_READY
+
+# Optional TTF fonts are parsed once at startup, not on every request.
+# _build_pdf checks pdfmetrics' registry, so a missing file just falls back.
+for _name, _path in (
+    ("Playfair", os.path.join(FONTS_DIR, "PlayfairDisplay-Bold.ttf")),
+    ("Cinzel", os.path.join(FONTS_DIR, "CinzelDecorative-Regular.ttf")),
+):
+    if _name not in pdfmetrics.getRegisteredFontNames() and os.path.exists(_path):
+        try:
+            pdfmetrics.registerFont(TTFont(_name, _path))
+        except Exception as e:
+            logger.warning("font register failed: %s: %s", _path, e)
+
+def _pdf_cache_version() -> str:
+    """Fingerprint of everything besides the request that shapes the PDF."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    h.update(reportlab.Version.encode())
+    fonts = [AMIRI_TTF]
+    if os.path.isdir(FONTS_DIR):
+        fonts += sorted(os.path.join(FONTS_DIR, n) for n in os.listdir(FONTS_DIR))
+    for path in fonts:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+# Part of every cache key, so a deploy that changes the code, ReportLab or the
+# font files never serves PDFs rendered by the previous version.
+PDF_CACHE_VERSION = _pdf_cache_version()
+
+# "logo" -> ((st_mtime_ns, st_size), ImageReader). Entries are only
+# replaced under _LOGO_LOCK, and only after the reader is fully decoded, so
+# render threads (and the key/reader pair they read) never see a partial load.
+_LOGO_CACHE = {}
+_LOGO_LOCK = threading.Lock()
+
+def get_logo():
+    """Return a cached ImageReader for LOGO_PATH, reloading it when the file changes.
+
+    Returns None when there is no logo or it can't be decoded; a bad file is
+    remembered under its key, so it is not re-read until it is replaced.
+    """
     try:
-        pdfmetrics.registerFont(TTFont("Amiri", AMIRI_TTF))
-        ARABIC_FONT = "Amiri"
-        print("✅ Amiri font registered.")
-    except Exception as e:
-        print("⚠️ Failed to register Amiri:", e)
+        st = os.stat(LOGO_PATH)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _LOGO_CACHE.get("logo")
+    if cached is None or cached[0] != key:
+        with _LOGO_LOCK:
+            cached = _LOGO_CACHE.get("logo")
+            if cached is None or cached[0] != key:
+                # ImageReader decodes lazily and PIL's PNG load is not thread-safe;
+                # decode now so render threads only ever see a fully loaded image.
+                try:
+                    reader = ImageReader(LOGO_PATH)
+                    reader.getRGBData()
+                except Exception as e:
+                    logger.warning("logo decode failed: %s", e)
+                    reader = None
+                cached = _LOGO_CACHE["logo"] = (key, reader)
+    return cached[1]
 
 class TemplateItem(BaseModel):
     perfumeName: Optional[str] = ""
@@ -63,8 +218,7 @@ class TemplateItem(BaseModel):
     def price_must_be_digits(cls, v):
         if not v:
             return v
-        cleaned = v.replace(" ", "").replace(",", "")
-        if not cleaned.isdigit():
+        if not _PRICE_RE.fullmatch(v):
             raise ValueError("price must contain digits only")
         return v
 
@@ -73,8 +227,7 @@ class TemplateItem(BaseModel):
     def multiplier_must_be_digits(cls, v):
         if not v:
             return v
-        cleaned = v.replace(" ", "").replace("×", "").replace("x", "")
-        if not cleaned.isdigit():
+        if not _MULTIPLIER_RE.fullmatch(v):
             raise ValueError("multiplier must contain digits only")
         return v
 
@@ -99,6 +252,13 @@ class StyleSettings(BaseModel):
     shopNameColor: Optional[str] = "#C5C0B0"
     quantityColor: Optional[str] = "#C5C0B0"
 
+    @field_validator("primaryColor", "accentColor", "extraInfoColor", "shopNameColor", "quantityColor")
+    @classmethod
+    def color_must_be_hex(cls, v):
+        if v and not _HEX_COLOR_RE.fullmatch(v):
+            raise ValueError("color must be a hex value like #D4AF37 or #D4AF37FF")
+        return v
+
 class GenerateRequest(BaseModel):
     shopName: Optional[str] = ""
     copies: int = Field(1, ge=1, le=35)
@@ -124,271 +284,407 @@ class GenerateRequest(BaseModel):
     @field_validator("labelWidth")
     @classmethod
     def width_fits_a4(cls, v):
-        from reportlab.lib.pagesizes import A4
-        page_w_mm = A4[0] / MM_TO_PT
-        if v > page_w_mm:
-            raise ValueError(f"label width must be <= page width ({page_w_mm:.1f} mm)")
+        if v > _PAGE_W_MM:
+            raise ValueError(f"label width must be <= page width ({_PAGE_W_MM:.1f} mm)")
         return v
 
     @field_validator("labelHeight")
     @classmethod
     def height_fits_a4(cls, v):
-        from reportlab.lib.pagesizes import A4
-        page_h_mm = A4[1] / MM_TO_PT
-        if v > page_h_mm:
-            raise ValueError(f"label height must be <= page height ({page_h_mm:.1f} mm)")
+        if v > _PAGE_H_MM:
+            raise ValueError(f"label height must be <= page height ({_PAGE_H_MM:.1f} mm)")
         return v
 
+def _save_logo(src):
+    # Write beside the logo and swap it in, so renders never read a half-written PNG.
+    tmp = f"{LOGO_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb", buffering=UPLOAD_CHUNK) as out:
+            shutil.copyfileobj(src, out, length=UPLOAD_CHUNK)
+        os.replace(tmp, LOGO_PATH)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp)
+        raise
+    with _LOGO_LOCK:
+        _LOGO_CACHE.pop("logo", None)
+
 @app.post("/upload_logo")
 async def upload_logo(file: UploadFile = File(...)):
     try:
-        with open(LOGO_PATH, "wb") as out:
-            shutil.copyfileobj(file.file, out)
+        await run_in_threadpool(_save_logo, file.file)
         return {"message": "Logo uploaded"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-from fastapi.exceptions import RequestValidationError
-from fastapi import status
-from fastapi.encoders import jsonable_encoder
-
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
-    print("❌ Validation error in request:")
-    print(exc.errors())
+    logger.warning("validation error in request: %s", exc.errors())
     return JSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={"detail": jsonable_encoder(exc.errors())},
     )
 
-@app.post("/generate_label")
-def generate_label(req: GenerateRequest):
+def _build_pdf(req: GenerateRequest) -> tuple:
+    """Render the label sheet for `req`.
+
+    Returns (pdf_bytes, complete); `complete` is False when part of the label
+    (the logo, or Arabic text without Amiri) could not be drawn properly, so
+    the result isn't cached.
+    """
+    complete = True
+    label_w_pt = mm_to_pt(req.labelWidth)
+    label_h_pt = mm_to_pt(req.labelHeight)
+    radius_pt = mm_to_pt(req.borderRadius)
+
+    page_w_pt, page_h_pt = A4
+    margin = mm_to_pt(6)
+
+    avail_w = page_w_pt - margin
+    avail_h = page_h_pt - margin
+    cols = max(1, int(avail_w / label_w_pt))
+    rows = max(1, int(avail_h / label_h_pt))
+    max_labels_per_page = cols * rows
+
+    primary_rgb = hex_to_rgb(req.style.primaryColor or "#D4AF37")
+    accent_rgb = hex_to_rgb(req.style.accentColor or "#080808")
+    extra_rgb = hex_to_rgb(req.style.extraInfoColor or "#E5E0D1")
+
+    # New colors for shop name and quantity
+    shop_rgb = hex_to_rgb(req.style.shopNameColor or "#C5C0B0")
+    quantity_rgb = hex_to_rgb(req.style.quantityColor or "#C5C0B0")
+
+    registered = STANDARD_FONTS.union(pdfmetrics.getRegisteredFontNames())
+
+    def usable_font(name, fallback):
+        if name in registered or (name == ARABIC_FONT and ensure_amiri()):
+            return name
+        return fallback
+
+    GOLD = primary_rgb
+    DARK = accent_rgb
+
+    logo = get_logo()
+    if logo is None and os.path.exists(LOGO_PATH):
+        complete = False  # the logo file is there but could not be decoded
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+
+    # Every label shares the same geometry. Positions are in label space
+    # (origin at the label's lower-left corner) and computed once.
+    padding = 8
+    inner_x = inner_y = 3
+    inner_w = label_w_pt - 6
+    inner_h = label_h_pt - 6
+    center_x = inner_x + inner_w / 2
+    logo_area_h = inner_h * 0.22
+    logo_w = min(inner_w * 0.4, logo_area_h - 6)
+    logo_h = logo_w
+    logo_x = inner_x + (inner_w - logo_w) / 2
+    logo_y = inner_y + inner_h - logo_h - padding - 2
+    line_w = inner_w * 0.4
+    line_x0 = inner_x + (inner_w - line_w) / 2
+    line_x1 = inner_x + (inner_w + line_w) / 2
+    extra_line_w = inner_w * 0.3
+    extra_line_x0 = inner_x + (inner_w - extra_line_w) / 2
+    extra_line_x1 = inner_x + (inner_w + extra_line_w) / 2
+    name_y_center = inner_y + inner_h * 0.56
+    name_max_h = inner_h * 0.4
+    extra_y_center = inner_y + inner_h * 0.30
+    extra_max_h = inner_h * 0.25
+    phone_x = inner_x + inner_w - padding - 2
+    phone_y = inner_y + 6
+
+    fs = req.fontSettings or FontSettings()
+    shop_size = fs.shopSize
+    price_size = fs.priceSize
+    quantity_size = fs.quantitySize
+    name_size = fs.perfumeSize if getattr(fs, "perfumeSize", None) else max(12, int(min(inner_w, inner_h) * 0.12))
+    extra_size = fs.extraInfoSize if getattr(fs, "extraInfoSize", None) else max(7, int(shop_size * 0.85))
+    phone_size = max(7, quantity_size - 1)
+    shop_dy = shop_size * 1.2
+    price_y = inner_y + padding + 8 + price_size * 0.6
+    # Fonts are resolved once per request; Arabic text switches to Amiri when it is available.
+    latin_shop_font = usable_font(fs.shopFont, "Times-Italic")
+    price_font = usable_font(fs.priceFont, "Helvetica-Bold")
+    quantity_font = usable_font(fs.quantityFont, "Helvetica")
+
+    # Last font / fill / stroke state emitted on the current page, so that settings
+    # shared by every label are only written to the content stream once.
+    pen = {}
+
+    def set_font(target, name, size):
+        if pen.get("font") != (name, size):
+            target.setFont(name, size)
+            pen["font"] = (name, size)
+
+    def set_fill(target, rgb):
+        if pen.get("fill") != rgb:
+            target.setFillColorRGB(*rgb)
+            pen["fill"] = rgb
+
+    def set_stroke(rgb, width):
+        if pen.get("stroke") != rgb:
+            c.setStrokeColorRGB(*rgb)
+            pen["stroke"] = rgb
+        if pen.get("width") != width:
+            c.setLineWidth(width)
+            pen["width"] = width
+
+    def resolve_template(tpl):
+        """Text and font choices for one template; copies of it reuse the result."""
+        pname = tpl.perfumeName or ""
+        name_font = ARABIC_FONT if contains_arabic(pname) and ensure_amiri() else "Helvetica-Bold"
+
+        shop_text = tpl.shopName or req.shopName or ""
+        shop_font = ARABIC_FONT if contains_arabic(shop_text) and ensure_amiri() else latin_shop_font
+
+        price_txt = tpl.price or req.price or ""
+        mult_txt = tpl.multiplier or "" or req.quantity or ""
+
+        extra = tpl.extraInfo or ""
+        extra_font = ARABIC_FONT if contains_arabic(extra) and ensure_amiri() else "Times-Italic"
+
+        phone = tpl.phone or req.phone
+
+        return (pname, name_font, shop_text, shop_font, price_txt, mult_txt, extra, extra_font, phone)
+
+    resolved = [resolve_template(tpl) for tpl in req.templates]
+    # Arabic drawn in a Latin fallback font is unreadable; serve it, don't cache it.
+    if any(
+        contains_arabic(text) for item in resolved for text in (item[0], item[2], item[6])
+    ) and not ensure_amiri():
+        complete = False
+
+    # Background, border and logo are identical on every label: emit them
+    # once as a Form XObject and reference it from each grid cell.
+    c.beginForm("labelFrame", 0, 0, label_w_pt, label_h_pt)
+    c.setFillColorRGB(*DARK)
+    c.roundRect(inner_x, inner_y, inner_w, inner_h, radius_pt, stroke=0, fill=1)
+    c.setLineWidth(1.2)
+    c.setStrokeColorRGB(*GOLD)
+    c.roundRect(inner_x + 1, inner_y + 1, inner_w - 2, inner_h - 2, radius_pt, stroke=1, fill=0)
+    if logo:
+        try:
+            c.drawImage(logo, logo_x, logo_y, logo_w, logo_h, mask='auto')
+        except Exception as e:
+            complete = False
+            logger.warning("drawImage failed: %s", e)
+    c.endForm()
+
+    def draw_label(item):
+        """Draw one label with its lower-left corner at the origin."""
+        pname, name_font, shop_text, shop_font, price_txt, mult_txt, extra, extra_font, phone = item
+
+        c.doForm("labelFrame")
+
+        p_style = ParagraphStyle(
+            name='PerfumeName',
+            fontName=name_font,
+            fontSize=name_size,
+            leading=name_size * 1.1,
+            alignment=TA_CENTER,
+            textColor=colors.Color(*GOLD)
+        )
+        p_text = pname.replace('\n', '<br/>')
+        p = Paragraph(p_text, p_style)
+        p_w, p_h = p.wrap(inner_w, name_max_h)
+
+        p.drawOn(c, inner_x, name_y_center - p_h / 2)
+
+        deco_y = (name_y_center - p_h / 2) - (name_size * 0.4)
+        set_stroke(GOLD, 1)
+        c.line(line_x0, deco_y, line_x1, deco_y)
+
+        if extra:
+            e_style = ParagraphStyle(
+                name='ExtraInfo',
+                fontName=extra_font,
+                fontSize=extra_size,
+                leading=extra_size * 1.1,
+                alignment=TA_CENTER,
+                textColor=colors.Color(*extra_rgb)
+            )
+            e_text = extra.replace('\n', '<br/>')
+            e_p = Paragraph(e_text, e_style)
+            e_w, e_h = e_p.wrap(inner_w, extra_max_h)
+
+            e_p.drawOn(c, inner_x, extra_y_center - e_h / 2)
+
+            set_stroke(GOLD, 0.6)
+            line_y = (extra_y_center - e_h / 2) - 4
+            c.line(extra_line_x0, line_y, extra_line_x1, line_y)
+
+        # Shop name, price, quantity and phone share a single BT/ET text object.
+        t = c.beginText()
+        # A fresh text object encodes strings with its own font (the canvas
+        # default), not the last Tf emitted, so it must always be given one.
+        pen.pop("font", None)
+
+        # Shop name with custom color
+        if shop_text:
+            set_font(t, shop_font, shop_size)
+            set_fill(t, shop_rgb)  # Use custom shop name color
+            t.setTextOrigin(center_x - _text_width(shop_text, shop_font, shop_size) / 2, deco_y - shop_dy)
+            t.textOut(shop_text)
+
+        if price_txt:
+            price_display = f"Prix(DA):{price_txt} "
+            set_font(t, price_font, price_size)
+            set_fill(t, GOLD)
+            t.setTextOrigin(center_x - _text_width(price_display, price_font, price_size) / 2, price_y)
+            t.textOut(price_display)
+
+        # Quantity with custom color
+        if mult_txt:
+            qty_display = f"(×{mult_txt})"
+            set_font(t, quantity_font, quantity_size)
+            set_fill(t, quantity_rgb)  # Use custom quantity color
+            t.setTextOrigin(center_x + 30, price_y)
+            t.textOut(qty_display)
+
+        if phone:
+            set_font(t, quantity_font, phone_size)
+            set_fill(t, (0.8, 0.78, 0.7))
+            t.setTextOrigin(phone_x - _text_width(phone, quantity_font, phone_size), phone_y)
+            t.textOut(phone)
+
+        c.drawText(t)
+
+    # Each distinct template is drawn once into its own form; grid cells
+    # only place a reference to it.
+    label_forms = {}
+    for item in resolved:
+        if item not in label_forms:
+            name = label_forms[item] = f"label{len(label_forms)}"
+            c.beginForm(name, 0, 0, label_w_pt, label_h_pt)
+            pen.clear()  # a form inherits whatever state is current where it is placed
+            draw_label(item)
+            c.endForm()
+    forms = [label_forms[item] for item in resolved]
+
+    # Copies that don't fit on one sheet continue on further A4 pages; the
+    # label forms are document-level, so later pages reuse them as-is.
+    for i, form in enumerate(islice(cycle(forms), req.copies)):
+        slot = i % max_labels_per_page
+        if i and not slot:
+            c.showPage()
+        row, col = divmod(slot, cols)
+        x = margin + col * label_w_pt
+        y = page_h_pt - margin - label_h_pt - row * label_h_pt
+        c.saveState()
+        c.translate(x, y)
+        c.doForm(form)
+        c.restoreState()
+
+    c.save()
+    return buf.getvalue(), complete
+
+def _pdf_cache_path(req: GenerateRequest) -> str:
+    """Cache file for `req`; the key also covers the current logo so uploads invalidate it."""
+    try:
+        st = os.stat(LOGO_PATH)
+        logo_key = f"{st.st_mtime_ns}:{st.st_size}"
+    except OSError:
+        logo_key = "-"
+    h = hashlib.blake2b(req.model_dump_json().encode(), digest_size=16)
+    h.update(logo_key.encode())
+    h.update(PDF_CACHE_VERSION.encode())
+    return os.path.join(PDF_CACHE_DIR, h.hexdigest() + ".pdf")
+
+def _store_cached_pdf(path: str, data: bytes):
+    """Atomically write a rendered PDF to the cache, then evict the least recently used files."""
+    global _PDF_CACHE_ENABLED
+    try:
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    except OSError as e:
+        _PDF_CACHE_ENABLED = False
+        logger.warning("PDF cache disabled, %s is not writable: %s", PDF_CACHE_DIR, e)
+        return
+    try:
+        tmp = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        entries = []
+        with os.scandir(PDF_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".pdf"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, old in sorted(entries):
+            if total <= PDF_CACHE_MAX_BYTES:
+                break
+            os.remove(old)
+            total -= size
+    except OSError as e:
+        logger.warning("PDF cache write failed: %s", e)
+
+def _replace_pdf_pool(broken: ProcessPoolExecutor) -> Optional[ProcessPoolExecutor]:
+    """Swap a broken pool for a fresh one (once, however many requests saw it break)."""
+    if app.state.pdf_pool is broken:
+        broken.shutdown(wait=False, cancel_futures=True)
+        try:
+            app.state.pdf_pool = _new_pdf_pool()
+        except (OSError, NotImplementedError) as e:
+            logger.warning("process pool unavailable, rendering in threads: %s", e)
+            app.state.pdf_pool = None
+    return app.state.pdf_pool
+
+async def _render_pdf(req: GenerateRequest) -> tuple:
+    pool = getattr(app.state, "pdf_pool", None)
+    if pool is None:
+        return await run_in_threadpool(_build_pdf, req)
+    async with app.state.pdf_slots:
+        for _ in range(2):
+            try:
+                return await asyncio.get_running_loop().run_in_executor(pool, _build_pdf, req)
+            except BrokenProcessPool:
+                # A worker died (OOM kill, segfault). Retry once on a fresh pool;
+                # the request stays out of the server process unless no pool can start.
+                logger.warning("pdf process pool broken, restarting it")
+                pool = _replace_pdf_pool(pool)
+                if pool is None:
+                    return await run_in_threadpool(_build_pdf, req)
+    # It broke a fresh pool too, so this payload is most likely what kills workers.
+    raise HTTPException(status_code=503, detail="label rendering failed, please try again")
+
+@app.post(
+    "/generate_label",
+    response_class=Response,
+    response_model=None,
+    responses={200: {"content": {"application/pdf": {}}}},
+)
+async def generate_label(req: GenerateRequest):
     try:
         if not req.templates or len(req.templates) == 0:
             raise HTTPException(status_code=400, detail="templates list is required and must contain at least one item")
+        if req.labelWidth <= 0 or req.labelHeight <= 0:
+            raise HTTPException(status_code=400, detail="labelWidth and labelHeight must be greater than 0")
 
-        label_w_pt = mm_to_pt(req.labelWidth)
-        label_h_pt = mm_to_pt(req.labelHeight)
-        radius_pt = mm_to_pt(req.borderRadius)
-
-        page_w_pt, page_h_pt = A4
-        margin = mm_to_pt(6)
-
-        cols = max(1, int((page_w_pt - margin) // label_w_pt))
-        rows = max(1, int((page_h_pt - margin) // label_h_pt))
-        max_labels_per_page = cols * rows
-
-        desired = []
-        idx = 0
-        while len(desired) < req.copies:
-            tpl = req.templates[idx % len(req.templates)]
-            desired.append(tpl)
-            idx += 1
-
-        to_generate = min(len(desired), max_labels_per_page)
-
-        primary_hex = (req.style.primaryColor or "#D4AF37").lstrip("#")
-        accent_hex = (req.style.accentColor or "#080808").lstrip("#")
-        primary_rgb = tuple(int(primary_hex[i:i+2], 16) / 255 for i in (0, 2, 4))
-        accent_rgb = tuple(int(accent_hex[i:i+2], 16) / 255 for i in (0, 2, 4))
-
-        extra_hex = (req.style.extraInfoColor or "#E5E0D1").lstrip("#")
-        extra_rgb = tuple(int(extra_hex[i:i+2], 16) / 255 for i in (0, 2, 4))
-
-        # New colors for shop name and quantity
-        shop_hex = (req.style.shopNameColor or "#C5C0B0").lstrip("#")
-        shop_rgb = tuple(int(shop_hex[i:i+2], 16) / 255 for i in (0, 2, 4))
-
-        quantity_hex = (req.style.quantityColor or "#C5C0B0").lstrip("#")
-        quantity_rgb = tuple(int(quantity_hex[i:i+2], 16) / 255 for i in (0, 2, 4))
-
-        def try_register(name, path):
-            if os.path.exists(path):
-                try:
-                    pdfmetrics.registerFont(TTFont(name, path))
-                    return name
-                except Exception as e:
-                    print("⚠️ font register failed:", path, e)
-            return None
-
-        fonts_dir = os.path.join(BASE_DIR, "fonts")
-        PLAYFAIR = try_register("Playfair", os.path.join(fonts_dir, "PlayfairDisplay-Bold.ttf"))
-        CINZEL = try_register("Cinzel", os.path.join(fonts_dir, "CinzelDecorative-Regular.ttf"))
-        if os.path.exists(AMIRI_TTF):
-            try:
-                pdfmetrics.registerFont(TTFont("Amiri", AMIRI_TTF))
-            except Exception as e:
-                print("⚠️ Amiri register failed:", e)
-
-        GOLD = primary_rgb
-        DARK = accent_rgb
-
-        logo = ImageReader(LOGO_PATH) if os.path.exists(LOGO_PATH) else None
-        c = canvas.Canvas(OUT_PDF, pagesize=A4)
-
-        def contains_arabic(s: str) -> bool:
-            if not s:
-                return False
-            for ch in s:
-                if "\u0600" <= ch <= "\u06FF" or "\u0750" <= ch <= "\u077F":
-                    return True
-            return False
-
-        def draw_label(x, y, tpl):
-            padding = 8
-            inner_x = x + 3
-            inner_y = y + 3
-            inner_w = label_w_pt - 6
-            inner_h = label_h_pt - 6
-
-            c.setFillColorRGB(*DARK)
-            c.roundRect(inner_x, inner_y, inner_w, inner_h, radius_pt, stroke=0, fill=1)
-
-            c.setLineWidth(1.2)
-            c.setStrokeColorRGB(*GOLD)
-            c.roundRect(inner_x + 1, inner_y + 1, inner_w - 2, inner_h - 2, radius_pt, stroke=1, fill=0)
-
-            logo_area_h = inner_h * 0.22
-            if logo:
-                max_logo_w = inner_w * 0.4
-                max_logo_h = logo_area_h - 6
-                logo_w = min(max_logo_w, max_logo_h)
-                logo_h = logo_w
-                lx = inner_x + (inner_w - logo_w) / 2
-                ly = inner_y + inner_h - logo_h - padding - 2
-                try:
-                    c.drawImage(logo, lx, ly, logo_w, logo_h, mask='auto')
-                except Exception as e:
-                    print("⚠️ drawImage failed:", e)
-
-            fs = req.fontSettings or FontSettings()
-
-            pname = tpl.perfumeName or ""
-            if contains_arabic(pname) and "Amiri" in pdfmetrics.getRegisteredFontNames():
-                name_font = "Amiri"
-            else:
-                name_font = "Helvetica-Bold"
-
-            name_size = fs.perfumeSize if getattr(fs, "perfumeSize", None) else max(12, int(min(inner_w, inner_h) * 0.12))
-            
-            p_style = ParagraphStyle(
-                name='PerfumeName',
-                fontName=name_font,
-                fontSize=name_size,
-                leading=name_size * 1.1,
-                alignment=TA_CENTER,
-                textColor=colors.Color(*GOLD)
-            )
-            p_text = pname.replace('\n', '<br/>')
-            p = Paragraph(p_text, p_style)
-            p_w, p_h = p.wrap(inner_w, inner_h * 0.4)
-            
-            name_y_center = inner_y + inner_h * 0.56
-            p.drawOn(c, inner_x, name_y_center - p_h / 2)
-
-            deco_y = (name_y_center - p_h / 2) - (name_size * 0.4)
-            c.setLineWidth(1)
-            c.setStrokeColorRGB(*GOLD)
-            line_w = inner_w * 0.4
-            c.line(inner_x + (inner_w - line_w) / 2, deco_y, inner_x + (inner_w + line_w) / 2, deco_y)
-
-            # Shop name with custom color
-            shop_text = tpl.shopName or req.shopName or ""
-            shop_font = "Amiri" if contains_arabic(shop_text) and "Amiri" in pdfmetrics.getRegisteredFontNames() else (fs.shopFont or "Times-Italic")
+        cache_path = _pdf_cache_path(req) if _PDF_CACHE_ENABLED else None
+        if cache_path and os.path.exists(cache_path):
             try:
-                c.setFont(shop_font, fs.shopSize)
-            except Exception:
-                c.setFont("Times-Italic", fs.shopSize)
-            c.setFillColorRGB(*shop_rgb)  # Use custom shop name color
-            c.drawCentredString(inner_x + inner_w / 2, deco_y - (fs.shopSize * 1.2), shop_text)
-
-            price_txt = tpl.price or req.price or ""
-            mult_txt = tpl.multiplier or "" or req.quantity or ""
-            bottom_y = inner_y + padding + 8
-
-            if price_txt:
-                price_display = f"Prix(DA):{price_txt} "
-                try:
-                    c.setFont(fs.priceFont or "Helvetica-Bold", fs.priceSize)
-                except:
-                    c.setFont("Helvetica-Bold", fs.priceSize)
-                c.setFillColorRGB(*GOLD)
-                c.drawCentredString(inner_x + inner_w / 2, bottom_y + (fs.priceSize * 0.6), price_display)
-
-            # Quantity with custom color
-            if mult_txt:
-                qty_display = f"(×{mult_txt})"
-                try:
-                    c.setFont(fs.quantityFont or "Helvetica", fs.quantitySize)
-                except:
-                    c.setFont("Helvetica", fs.quantitySize)
-                c.setFillColorRGB(*quantity_rgb)  # Use custom quantity color
-                c.drawString(inner_x + inner_w/2 + 30, bottom_y + (fs.priceSize * 0.6), qty_display)
-
-            extra = tpl.extraInfo or ""
-            if extra:
-                if contains_arabic(extra) and "Amiri" in pdfmetrics.getRegisteredFontNames():
-                    extra_font = "Amiri"
-                else:
-                    extra_font = "Times-Italic"
-                extra_size = fs.extraInfoSize if getattr(fs, "extraInfoSize", None) else max(7, int(fs.shopSize * 0.85))
-                
-                extra_y_center = inner_y + inner_h * 0.30
-                
-                e_style = ParagraphStyle(
-                    name='ExtraInfo',
-                    fontName=extra_font,
-                    fontSize=extra_size,
-                    leading=extra_size * 1.1,
-                    alignment=TA_CENTER,
-                    textColor=colors.Color(*extra_rgb)
-                )
-                e_text = extra.replace('\n', '<br/>')
-                e_p = Paragraph(e_text, e_style)
-                e_w, e_h = e_p.wrap(inner_w, inner_h * 0.25)
-                
-                e_p.drawOn(c, inner_x, extra_y_center - e_h / 2)
-
-                c.setStrokeColorRGB(*GOLD)
-                c.setLineWidth(0.6)
-                line_w = inner_w * 0.3
-                line_y = (extra_y_center - e_h / 2) - 4
-                c.line(inner_x + (inner_w - line_w) / 2, line_y, inner_x + (inner_w + line_w) / 2, line_y)
-
-            if isinstance(tpl, dict):
-                phone = tpl.get("phone") or tpl.get("tel")
-            else:
-                phone = getattr(tpl, "phone", None)
-            if not phone:
-                phone = getattr(req, "phone", None)
-
-            if phone:
-                try:
-                    c.setFont(fs.quantityFont or "Helvetica", max(7, fs.quantitySize - 1))
-                except:
-                    c.setFont("Helvetica", max(7, fs.quantitySize - 1))
-                c.setFillColorRGB(0.8, 0.78, 0.7)
-                c.drawRightString(inner_x + inner_w - padding - 2, inner_y + 6, phone)
-
-        count = 0
-        for r in range(rows):
-            for col in range(cols):
-                if count >= to_generate:
-                    break
-                x = margin + col * label_w_pt
-                y = page_h_pt - margin - label_h_pt - r * label_h_pt
-                draw_label(x, y, desired[count])
-                count += 1
-            if count >= to_generate:
-                break
-
-        c.save()
-        return FileResponse(OUT_PDF, media_type="application/pdf", filename="labels.pdf")
+                os.utime(cache_path)  # mark as recently used for eviction
+                return FileResponse(cache_path, media_type="application/pdf", filename="labels.pdf")
+            except OSError:
+                pass  # evicted between the check and the hit; render it again
+
+        pdf, complete = await _render_pdf(req)
+        if complete and cache_path:
+            await run_in_threadpool(_store_cached_pdf, cache_path, pdf)
+        return Response(
+            pdf,
+            media_type="application/pdf",
+            headers={"Content-Disposition": 'attachment; filename="labels.pdf"'},
+        )
 
     except HTTPException as he:
         raise he
     except Exception as e:
-        print("❌ generate_label error:", e)
+        logger.exception("generate_label failed")
         with open("error.log", "a", encoding="utf-8") as f:
             f.write(f"Error: {str(e)}\n")
             f.write(traceback.format_exc() + "\n")